@@ -1,8 +1,25 @@
 import os
-import json
-import time
+import re
+import asyncio
 import argparse
-import httpx
+import aiohttp
+import aiofiles
+from pybloom_live import ScalableBloomFilter
+
+try:
+    import hyperscan
+except ImportError:  # tag filtering falls back to substring probes
+    hyperscan = None
+from utils import json_loads, json_dumps_line, PageCacheDropper
+
+
+TASKS_COUNT = 32
+CHUNK_SIZE = 1 << 16
+METADATA_FLUSH_INTERVAL = 100
+_ALLOWED_EXTS = frozenset({".jpg", ".jpeg", ".png", ".webp"})
+
+# Whitespace-delimited tags, dropping single-character tags that are not alphanumeric
+_TAG_RE = re.compile(r"(?<!\S)(?:\S{2,}|[^\W_])(?!\S)")
 
 
 class DanbooruCrawler:
@@ -20,24 +37,93 @@ class DanbooruCrawler:
         self.username = username
         self.api_key = api_key
         self.output_dir = output_dir
-        self.metadata_path = os.path.join(output_dir, "metadata")
-        self.tags = set(tags or [])
+        self.tags = frozenset(tags or [])
+        # Space-padded tags so a substring test only matches whole tags
+        self._tag_probe = [f" {tag.lower()} " for tag in self.tags]
+        self._have_tags = bool(self.tags)
+        self._tag_db = self.compile_tag_db()
         self.start_page = start_page
         self.max_pages = max_pages
         self.images_per_page = min(images_per_page, 200)
 
         os.makedirs(self.output_dir, exist_ok=True)
-        os.makedirs(self.metadata_path, exist_ok=True)
 
         self.headers = {
             "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/123.0.0.0 Safari/537.36",
             "Referer": "https://danbooru.donmai.us"
         }
 
-        self.metadata = []
+        self.saved_count = 0
+        self.seen_path = os.path.join(output_dir, "seen_ids.bloom")
+        self.seen = self.load_seen()
+        self.meta_fp = open(os.path.join(output_dir, "metadata.jsonl"), "ab")
+        self._session = None
+        self.page_cache = PageCacheDropper()
+
+    async def __aenter__(self):
+        # One session for every request so connections and DNS lookups are reused
+        # Every worker may hit the same CDN host, so allow one connection each
+        connector = aiohttp.TCPConnector(limit=100, limit_per_host=TASKS_COUNT, ttl_dns_cache=300)
+        # Per-phase timeouts only; a cap on the total would abort large downloads
+        self._session = aiohttp.ClientSession(
+            connector=connector,
+            headers=self.headers,
+            timeout=aiohttp.ClientTimeout(total=None, sock_connect=30, sock_read=30)
+        )
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self._session.close()
+        self.meta_fp.close()
+        self.save_seen()
+
+    def compile_tag_db(self):
+        """Compile the filter tags into one hyperscan database, if available"""
+        if hyperscan is None or not self.tags:
+            return None
+        tags = sorted(self.tags)
+        db = hyperscan.Database()
+        db.compile(
+            expressions=[f"(?:^| ){re.escape(tag)}(?: |$)".encode() for tag in tags],
+            ids=list(range(len(tags))),
+            flags=[hyperscan.HS_FLAG_CASELESS | hyperscan.HS_FLAG_UTF8 | hyperscan.HS_FLAG_UCP] * len(tags)
+        )
+        return db
+
+    def match_tags(self, tag_string):
+        """Return True if tag_string contains any of the filter tags"""
+        if self._tag_db is None:
+            tag_string = f" {tag_string.lower()} "
+            return any(probe in tag_string for probe in self._tag_probe)
+
+        matched = []
+
+        def on_match(tag_id, start, end, flags, context):
+            matched.append(tag_id)
+            return True  # Stop scanning at the first hit
 
-    def fetch_posts(self, client, page):
-        time.sleep(2)
+        try:
+            self._tag_db.scan(tag_string.encode(), match_event_handler=on_match)
+        except hyperscan.ScanTerminated:
+            pass
+        return bool(matched)
+
+    def load_seen(self):
+        """Load the IDs downloaded in previous sessions"""
+        if os.path.exists(self.seen_path):
+            with open(self.seen_path, "rb") as f:
+                return ScalableBloomFilter.fromfile(f)
+        return ScalableBloomFilter(mode=ScalableBloomFilter.LARGE_SET_GROWTH)
+
+    def save_seen(self):
+        # Write a temp file and swap it in, so an interrupted save can't corrupt the filter
+        tmp_path = f"{self.seen_path}.tmp"
+        with open(tmp_path, "wb") as f:
+            self.seen.tofile(f)
+        os.replace(tmp_path, self.seen_path)
+
+    async def fetch_posts(self, page):
+        await asyncio.sleep(2)
         params = {
             "page": page,
             "limit": self.images_per_page,
@@ -48,100 +134,134 @@ class DanbooruCrawler:
             params["tag_string"] = " ".join(self.tags)
 
         try:
-            response = client.get(self.base_url, params=params)
-            response.raise_for_status()
-            return response.json()
+            async with self._session.get(self.base_url, params=params) as response:
+                response.raise_for_status()
+                return json_loads(await response.read())
         except Exception as e:
             print(f"[ERROR] Failed to fetch page {page}: {e}")
             return []
 
-    def download_image(self, client, url, save_path):
+    async def download_image(self, url, save_path):
         try:
-            response = client.get(url)
-            response.raise_for_status()
-            with open(save_path, "wb") as f:
-                f.write(response.content)
+            async with self._session.get(url) as response:
+                response.raise_for_status()
+                async with aiofiles.open(save_path, "wb") as f:
+                    # Coalesce network reads so each file write is a full chunk
+                    buffer = bytearray()
+                    async for chunk in response.content.iter_chunked(CHUNK_SIZE):
+                        buffer += chunk
+                        if len(buffer) >= CHUNK_SIZE:
+                            await f.write(buffer)
+                            buffer.clear()
+                    if buffer:
+                        await f.write(buffer)
+            self.page_cache.add(save_path)
             return True
         except Exception as e:
             print(f"[ERROR] Failed to download image: {e}")
+            # Don't leave a truncated file behind
+            if os.path.exists(save_path):
+                os.remove(save_path)
             return False
 
-    def crawl(self):
+    async def download_task(self, queue):
+        while True:
+            image_url, save_path, metadata = await queue.get()
+            try:
+                success = await self.download_image(image_url, save_path)
+                if not success:
+                    continue
+
+                self.seen.add(str(metadata["id"]))
+                self.meta_fp.write(json_dumps_line(metadata))
+                self.saved_count += 1
+                if self.saved_count % METADATA_FLUSH_INTERVAL == 0:
+                    self.meta_fp.flush()
+                    self.save_seen()
+            finally:
+                queue.task_done()
+
+    async def crawl(self):
         print(f"Start crawling Danbooru (start page: {self.start_page}, per page: {self.images_per_page})")
         image_id_set = set()
+        queue = asyncio.Queue()
+
+        consumers = [asyncio.create_task(self.download_task(queue)) for _ in range(TASKS_COUNT)]
 
-        with httpx.Client(http2=True, headers=self.headers, timeout=30.0) as client:
-            empty_post_cnt = 0
-            for page in range(self.start_page, self.max_pages + 1):
-                print(f'crawling tags: {self.tags}, page: {page}')
-                posts = self.fetch_posts(client, page)
-
-                if not posts:
-                    empty_post_cnt += 1
-                    print(f"[INFO] Empty post count: {empty_post_cnt}")
-                    if empty_post_cnt >= 3:
-                        print(f"[INFO] No more posts returned at page {page}, stopping early.")
-                        break
-                    else:
-                        continue
+        empty_post_cnt = 0
+        for page in range(self.start_page, self.max_pages + 1):
+            print(f'crawling tags: {self.tags}, page: {page}')
+            posts = await self.fetch_posts(page)
+
+            if not posts:
+                empty_post_cnt += 1
+                print(f"[INFO] Empty post count: {empty_post_cnt}")
+                if empty_post_cnt >= 3:
+                    print(f"[INFO] No more posts returned at page {page}, stopping early.")
+                    break
                 else:
-                    empty_post_cnt = 0
+                    continue
+            else:
+                empty_post_cnt = 0
 
-                for post in posts:
-                    if not post.get("file_url"):
-                        continue
+            for post in posts:
+                if not post.get("file_url"):
+                    continue
 
-                    post_tags = set(post.get('tag_string', '').lower().split())
-                    if self.tags and not self.tags & post_tags:
-                        continue
+                if self._have_tags and not self.match_tags(post.get('tag_string', '')):
+                    continue
 
-                    image_id = post["id"]
-                    if image_id in image_id_set:
-                        continue
-                    image_id_set.add(image_id)
+                image_id = post["id"]
+                if image_id in image_id_set or str(image_id) in self.seen:
+                    continue
+                image_id_set.add(image_id)
 
-                    image_url = f"https://danbooru.donmai.us{post['file_url']}" if post["file_url"].startswith("/") else post["file_url"]
-                    image_ext = os.path.splitext(image_url)[-1]
+                image_url = f"https://danbooru.donmai.us{post['file_url']}" if post["file_url"].startswith("/") else post["file_url"]
+                # Danbooru file URLs always end in a plain extension
+                dot, _, ext = image_url.rpartition(".")
+                image_ext = f".{ext.lower()}"
+                if not dot or image_ext not in _ALLOWED_EXTS:
+                    continue
 
-                    if image_ext not in {".jpg", ".jpeg", ".png", ".webp"}:
-                        continue
+                filename = f"{image_id}{image_ext}"
+                save_path = os.path.join(self.output_dir, filename)
 
-                    filename = f"{image_id}{image_ext}"
-                    save_path = os.path.join(self.output_dir, filename)
+                tags = clean_tags(post.get("tag_string", ""))
+                if post.get("rating") == "e":
+                    tags.insert(0, "R-18")
 
-                    success = self.download_image(client, image_url, save_path)
-                    if not success:
-                        continue
-                    
-                    tags = clean_tags(post.get("tag_string", ""))
-                    if post.get("rating") == "e":
-                        tags.insert(0, "R-18")
+                metadata = {
+                    "id": image_id,
+                    "file_name": filename,
+                    "width": post.get("image_width"),
+                    "height": post.get("image_height"),
+                    "tags": tags,
+                    "rating": post.get("rating"),
+                    "source": post.get("source"),
+                    "score": post.get("score")
+                }
 
-                    metadata = {
-                        "id": image_id,
-                        "file_name": filename,
-                        "width": post.get("image_width"),
-                        "height": post.get("image_height"),
-                        "tags": tags,
-                        "rating": post.get("rating"),
-                        "source": post.get("source"),
-                        "score": post.get("score")
-                    }
+                await queue.put((image_url, save_path, metadata))
 
-                    self.metadata.append(metadata)
+            # Drain this page before requesting the next one
+            await queue.join()
 
-                    with open(os.path.join(self.metadata_path, f"{image_id}.json"), "w", encoding="utf-8") as f:
-                        json.dump(metadata, f, ensure_ascii=False, indent=2)
+        for consumer in consumers:
+            consumer.cancel()
+        await asyncio.gather(*consumers, return_exceptions=True)
 
-        print(f"Download complete: {len(self.metadata)} images saved to '{self.output_dir}'")
+        print(f"Download complete: {self.saved_count} images saved to '{self.output_dir}'")
 
 
 def clean_tags(raw_tag_string):
-    tags = raw_tag_string.split()
-    return [tag for tag in tags if tag.isalnum() or len(tag) > 1]
+    return _TAG_RE.findall(raw_tag_string)
+
+async def run(crawler):
+    async with crawler:
+        await crawler.crawl()
 
 def main():
-    parser = argparse.ArgumentParser(description="Danbooru Image Crawler (httpx)")
+    parser = argparse.ArgumentParser(description="Danbooru Image Crawler (aiohttp)")
     parser.add_argument("--username", type=str, required=True, help="username")
     parser.add_argument("--api-key", type=str, required=True, help="api key")
     parser.add_argument("--output-dir", default="danbooru_images", help="Directory to save images and metadata")
@@ -160,7 +280,7 @@ def main():
         max_pages=args.end_page, 
         images_per_page=args.limit
     )
-    crawler.crawl()
+    asyncio.run(run(crawler))
 
 if __name__ == "__main__":
     main()
@@ -1,26 +1,76 @@
 import os
-import json
-import time
 import random
+import asyncio
 import argparse
-import requests
+import dataclasses
+import httpx
+import aiofiles
 from tqdm import tqdm
-from requests.adapters import HTTPAdapter
-from urllib3.util.retry import Retry
+from urllib.parse import quote
+from aiolimiter import AsyncLimiter
+from utils import json_loads, json_dumps_line, PageCacheDropper
+
+
+METADATA_FLUSH_INTERVAL = 100
+
+
+@dataclasses.dataclass(slots=True)
+class IllustMeta:
+    """Metadata of one page of an illustration"""
+    id: str
+    title: str
+    user_id: str
+    user_name: str
+    tags: list
+    create_date: str
+    width: int
+    height: int
+    page_count: int
+    bookmark_count: int
+    like_count: int
+    view_count: int
+    comment_count: int
+    is_original: bool
+    is_r18: bool
+    page: int = 0
+    filename: str = ''
 
 
 class PixivCrawler:
-    def __init__(self, cookie_file, output_dir="images"):
+    def __init__(self, cookie_file, output_dir="images", concurrency=8, download_concurrency=16,
+                 exclude_tags=None, skip_ai=False):
         self.cookie_file = cookie_file
         self.cookies = self.load_cookies()
         self.current_cookie_index = 0
         self.output_dir = output_dir
-        self.metadata_dir = os.path.join(output_dir, "metadata")
-        self.last_request_time = 0
-        self.min_request_interval = 2.0  # Minimum seconds between requests
+        self.metadata_file = os.path.join(output_dir, "metadata.jsonl")
+        self.exclude_tags = frozenset(exclude_tags or [])
+        self.skip_ai = skip_ai
+        self.semaphore = asyncio.Semaphore(concurrency)  # Illustrations processed at once
+        # Image streams open at once, across all illustrations and their pages
+        self.download_semaphore = asyncio.Semaphore(download_concurrency)
+        self.downloaded_count = 0
+        self._reserved_count = 0
+        # Token bucket for the ajax API (search and details): bursts are allowed,
+        # sustained load is held to 30/min. CDN downloads use download_semaphore instead.
+        self.limiter = AsyncLimiter(30, 60)
         os.makedirs(output_dir, exist_ok=True)
-        os.makedirs(self.metadata_dir, exist_ok=True)
-        self.session = self.create_session()
+        # Scan once so skip checks don't stat() every candidate file
+        self._existing = {entry.name for entry in os.scandir(self.output_dir) if entry.is_file()}
+        self.meta_fp = open(self.metadata_file, 'ab')
+        self.page_cache = PageCacheDropper()
+        self.metadata_count = 0
+        self._sessions = {}
+        self.session = self.get_session(self.current_cookie_index)
+        self._rotate_lock = asyncio.Lock()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        # Runs on errors and Ctrl-C too, so buffered metadata is never lost
+        await self.close_sessions()
+        self.meta_fp.close()
 
     def load_cookies(self):
         """Load cookies from file"""
@@ -36,115 +86,129 @@ class PixivCrawler:
 
         return cookies
 
-    def create_session(self):
-        """Create a new session with current cookie"""
-        session = requests.Session()
+    def create_session(self, cookie):
+        """Create a new async HTTP/2 client with the given cookie"""
+        cookies = httpx.Cookies()
+        cookies.set('PHPSESSID', cookie, domain='.pixiv.net')
 
-        # Configure retry strategy
-        retry_strategy = Retry(
-            total=3,  # Maximum number of retries
-            backoff_factor=1,  # Wait 1, 2, 4, 8, 16 seconds between retries
-            # Retry on these status codes
-            status_forcelist=[429, 500, 502, 503, 504]
+        # Retry failed connections; HTTP error statuses are retried by the callers
+        transport = httpx.AsyncHTTPTransport(
+            http2=True,
+            retries=3,
+            limits=httpx.Limits(max_connections=100, max_keepalive_connections=20)
+        )
+        return httpx.AsyncClient(
+            transport=transport,
+            headers={
+                'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/135.0.0.0 Safari/537.36',
+                'Referer': 'https://www.pixiv.net/'
+            },
+            cookies=cookies,
+            timeout=30.0,
+            follow_redirects=True
         )
-        adapter = HTTPAdapter(max_retries=retry_strategy)
-        session.mount("http://", adapter)
-        session.mount("https://", adapter)
-
-        session.headers.update({
-            'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/135.0.0.0 Safari/537.36',
-            'Referer': 'https://www.pixiv.net/'
-        })
-        session.cookies.set(
-            'PHPSESSID', self.cookies[self.current_cookie_index], domain='.pixiv.net')
-        return session
     
-    def rate_limit(self):
-        """Enforce rate limiting between requests"""
-        current_time = time.time()
-        time_since_last_request = current_time - self.last_request_time
-        if time_since_last_request < self.min_request_interval:
-            sleep_time = self.min_request_interval - time_since_last_request
-            # Add some randomness
-            time.sleep(sleep_time + random.uniform(0.1, 0.5))
-        self.last_request_time = time.time()
-
-    def rotate_cookie(self):
-        """Rotate to next cookie"""
-        self.current_cookie_index = (self.current_cookie_index + 1) % len(self.cookies)
-        self.session = self.create_session()
-        print(f"Rotated to cookie {self.current_cookie_index + 1}/{len(self.cookies)}")
-        time.sleep(5)  # Wait after rotating cookie
-
-    def save_metadata(self, illust_id, metadata):
-        """Save image metadata to JSON file"""
-        metadata_file = os.path.join(self.metadata_dir, f"{illust_id}.json")
-        with open(metadata_file, 'w', encoding='utf-8') as f:
-            json.dump(metadata, f, ensure_ascii=False, indent=2)
-
-    def download_image(self, image_url, image_id, metadata, page_index=0):
-        try:
-            filename = f"{image_id}_p{page_index}.jpg"
-            filepath = os.path.join(self.output_dir, filename)
+    def get_session(self, index):
+        """Return the client for a cookie, creating it on first use"""
+        session = self._sessions.get(index)
+        if session is None:
+            session = self.create_session(self.cookies[index])
+            self._sessions[index] = session
+        return session
 
-            if os.path.exists(filepath):
-                return False
+    async def close_sessions(self):
+        """Close the clients of every cookie used"""
+        for session in self._sessions.values():
+            await session.aclose()
+        self._sessions.clear()
+
+    async def rotate_cookie(self, from_index):
+        """Rotate to the cookie after from_index, unless another task already rotated away from it"""
+        async with self._rotate_lock:
+            # Concurrent tasks failing on the same cookie must rotate only once
+            if self.current_cookie_index != from_index:
+                return
+            self.current_cookie_index = (self.current_cookie_index + 1) % len(self.cookies)
+            self.session = self.get_session(self.current_cookie_index)
+            print(f"Rotated to cookie {self.current_cookie_index + 1}/{len(self.cookies)}")
+            await asyncio.sleep(5)  # Wait after rotating cookie
+
+    def save_metadata(self, metadata):
+        """Append image metadata to the JSONL file"""
+        self.meta_fp.write(json_dumps_line(metadata))
+        self.metadata_count += 1
+        if self.metadata_count % METADATA_FLUSH_INTERVAL == 0:
+            self.meta_fp.flush()
+
+    async def download_image(self, image_url, image_id, metadata, page_index=0):
+        filename = f"{image_id}_p{page_index}.jpg"
+        filepath = os.path.join(self.output_dir, filename)
+        if filename in self._existing:
+            return False
 
-            response = self.session.get(image_url, stream=True)
-            response.raise_for_status()
+        try:
+            async with self.download_semaphore, self.session.stream('GET', image_url) as response:
+                response.raise_for_status()
 
-            with open(filepath, 'wb') as f:
-                for chunk in response.iter_content(chunk_size=8192):
-                    f.write(chunk)
+                async with aiofiles.open(filepath, 'wb') as f:
+                    async for chunk in response.aiter_bytes(65536):
+                        await f.write(chunk)
 
-            metadata['filename'] = filename
-            self.save_metadata(f"{image_id}_p{page_index}", metadata)
+            self.page_cache.add(filepath)
+            self._existing.add(filename)
+            metadata.filename = filename
+            self.save_metadata(metadata)
 
             return True
 
         except Exception as e:
             print(f"Error downloading {image_url}: {str(e)}")
+            # Don't leave a truncated file behind, it would be skipped on later runs
+            if os.path.exists(filepath):
+                os.remove(filepath)
             return False
     
-    def get_image_details(self, illust_id, max_retries=3):
+    async def get_image_details(self, illust_id, max_retries=3):
         """Get image details with retry logic (handles multi-page works)"""
         for attempt in range(max_retries):
+            cookie_index, session = self.current_cookie_index, self.session
             try:
-                self.rate_limit()
+                # Page list and illustration metadata are independent, fetch both at once
                 detail_url = f"https://www.pixiv.net/ajax/illust/{illust_id}/pages"
-                response = self.session.get(detail_url)
+                meta_url = f"https://www.pixiv.net/ajax/illust/{illust_id}"
+                await self.limiter.acquire(2)
+                response, meta_response = await asyncio.gather(
+                    session.get(detail_url),
+                    session.get(meta_url)
+                )
                 response.raise_for_status()
-                pages = response.json()
+                pages = json_loads(response.content)
 
-                # Get illustration metadata
-                self.rate_limit()
-                meta_url = f"https://www.pixiv.net/ajax/illust/{illust_id}"
-                meta_response = self.session.get(meta_url)
                 meta_response.raise_for_status()
-                meta_data = meta_response.json()
+                meta_data = json_loads(meta_response.content)
 
                 if meta_data.get('error'):
                     print(f"Error getting metadata: {meta_data['error']['message']}")
                     return [], []
 
                 meta_body = meta_data['body']
-                base_metadata = {
-                    'id': illust_id,
-                    'title': meta_body.get('title', ''),
-                    'user_id': meta_body.get('userId', ''),
-                    'user_name': meta_body.get('userName', ''),
-                    'tags': [tag['tag'] for tag in meta_body.get('tags', {}).get('tags', [])],
-                    'create_date': meta_body.get('createDate', ''),
-                    'width': meta_body.get('width', 0),
-                    'height': meta_body.get('height', 0),
-                    'page_count': meta_body.get('pageCount', 1),
-                    'bookmark_count': meta_body.get('bookmarkCount', 0),
-                    'like_count': meta_body.get('likeCount', 0),
-                    'view_count': meta_body.get('viewCount', 0),
-                    'comment_count': meta_body.get('commentCount', 0),
-                    'is_original': meta_body.get('isOriginal', False),
-                    'is_r18': meta_body.get('xRestrict', 0) > 0,
-                }
+                base_metadata = IllustMeta(
+                    id=illust_id,
+                    title=meta_body.get('title', ''),
+                    user_id=meta_body.get('userId', ''),
+                    user_name=meta_body.get('userName', ''),
+                    tags=[tag['tag'] for tag in meta_body.get('tags', {}).get('tags', [])],
+                    create_date=meta_body.get('createDate', ''),
+                    width=meta_body.get('width', 0),
+                    height=meta_body.get('height', 0),
+                    page_count=meta_body.get('pageCount', 1),
+                    bookmark_count=meta_body.get('bookmarkCount', 0),
+                    like_count=meta_body.get('likeCount', 0),
+                    view_count=meta_body.get('viewCount', 0),
+                    comment_count=meta_body.get('commentCount', 0),
+                    is_original=meta_body.get('isOriginal', False),
+                    is_r18=meta_body.get('xRestrict', 0) > 0,
+                )
 
                 image_urls = []
                 metadata_list = []
@@ -155,26 +219,68 @@ class PixivCrawler:
                         continue
                     image_urls.append(image_url)
 
-                    meta_copy = dict(base_metadata)
-                    meta_copy['page'] = i
-                    metadata_list.append(meta_copy)
+                    metadata_list.append(dataclasses.replace(base_metadata, page=i))
 
                 return image_urls, metadata_list
 
-            except requests.exceptions.RequestException as e:
+            except httpx.HTTPError as e:
                 if attempt < max_retries - 1:
                     wait_time = (2 ** attempt) + random.uniform(0, 1)
                     print(f"Retrying in {wait_time:.1f} seconds... (Attempt {attempt + 1}/{max_retries})")
-                    time.sleep(wait_time)
+                    await asyncio.sleep(wait_time)
                     if "429" in str(e):
-                        self.rotate_cookie()
+                        await self.rotate_cookie(cookie_index)
                 else:
                     print(f"Failed to get image details after {max_retries} attempts: {str(e)}")
                     return [], []
 
+            except (ValueError, KeyError) as e:
+                # Malformed response body, retrying won't help
+                print(f"Invalid image details for {illust_id}: {str(e)}")
+                return [], []
+
         return [], []
 
-    def search_and_download(self, tags, max_images, mode='s_tag', rating='all'):
+    def _should_fetch(self, illust, rating):
+        """Filter search results before spending any requests on them"""
+        if illust.get('illustType') != 0:  # 0 = single image
+            return False
+        if rating == 'safe' and illust.get('xRestrict', 0) > 0:
+            return False
+        if rating == 'r18' and illust.get('xRestrict', 0) == 0:
+            return False
+        if self.skip_ai and illust.get('aiType') == 2:  # 2 = AI-generated
+            return False
+        if self.exclude_tags and not self.exclude_tags.isdisjoint(illust.get('tags', [])):
+            return False
+        return True
+
+    async def process_illust(self, illust_id, max_images, pbar):
+        """Fetch illustration details, then download all of its pages in parallel"""
+        async with self.semaphore:
+            if self.downloaded_count >= max_images:
+                return 0
+            image_urls, metadata_list = await self.get_image_details(illust_id)
+
+            # Reserve slots so concurrent illustrations don't overshoot max_images
+            budget = max_images - self.downloaded_count - self._reserved_count
+            if budget <= 0:
+                return 0
+            pages = list(enumerate(zip(image_urls, metadata_list)))[:budget]
+            self._reserved_count += len(pages)
+
+            results = await asyncio.gather(*[
+                self.download_image(image_url, illust_id, metadata, page_index)
+                for page_index, (image_url, metadata) in pages
+            ])
+            self._reserved_count -= len(pages)
+
+            downloaded = sum(results)
+            self.downloaded_count += downloaded
+            pbar.update(downloaded)
+            return downloaded
+
+    async def search_and_download(self, tags, max_images, mode='s_tag', rating='all'):
         """
         Search and download images by tags
 
@@ -192,11 +298,9 @@ class PixivCrawler:
         """
         print(f"Searching for images with tags: {', '.join(tags)}")
 
-        # Search URL
-        search_url = "https://www.pixiv.net/ajax/search/artworks/" + \
-            "%20".join(tags)
+        # Search URL, the path already carries the search words
+        search_url = f"https://www.pixiv.net/ajax/search/artworks/{quote(' '.join(tags), safe='')}"
         params = {
-            'word': " ".join(tags),
             'order': 'date_d',
             'mode': 'all',
             'p': 1,
@@ -206,52 +310,50 @@ class PixivCrawler:
             'rating': rating
         }
 
-        downloaded_count = 0
+        self.downloaded_count = 0
         page = 1
         consecutive_errors = 0
 
-        with tqdm(total=max_images, desc="Downloading images") as pbar:
-            while downloaded_count < max_images:
+        # Progress is reported once per illustration; throttle redraws further
+        with tqdm(total=max_images, desc="Downloading images",
+                  miniters=16, mininterval=0.5, dynamic_ncols=False) as pbar:
+            while self.downloaded_count < max_images:
+                cookie_index, session = self.current_cookie_index, self.session
                 try:
                     # Update page number
                     params['p'] = page
 
                     # Get search results
-                    response = self.session.get(search_url, params=params)
+                    async with self.limiter:
+                        response = await session.get(search_url, params=params)
                     response.raise_for_status()
-                    data = response.json()
+                    data = json_loads(response.content)
 
                     if not data.get('body', {}).get('illustManga', {}).get('data'):
                         break
 
-                    # Process each illustration
-                    for illust in data['body']['illustManga']['data']:
-                        if downloaded_count >= max_images:
-                            break
-
-                        # Skip if not single image
-                        if illust.get('illustType') != 0:  # 0 = single image
-                            continue
-
-                        # Get image URL and metadata
-                        image_urls, metadata_list = self.get_image_details(illust['id'])
-
-                        if not image_urls or not metadata_list:
-                            continue
-
-                        for page_index, (image_url, metadata) in enumerate(zip(image_urls, metadata_list)):
-                            if self.download_image(image_url, illust['id'], metadata, page_index):
-                                downloaded_count += 1
-                                pbar.update(1)
-                                consecutive_errors = 0
-
-                            if downloaded_count >= max_images:
-                                break
+                    candidates = [
+                        illust for illust in data['body']['illustManga']['data']
+                        if self._should_fetch(illust, rating)
+                    ]
+
+                    # Process the illustrations concurrently
+                    results = await asyncio.gather(*[
+                        self.process_illust(illust['id'], max_images, pbar)
+                        for illust in candidates
+                    ], return_exceptions=True)
+
+                    # A failing illustration must not abort (and endlessly retry) the page
+                    downloaded = 0
+                    for illust, result in zip(candidates, results):
+                        if isinstance(result, Exception):
+                            print(f"Error processing illust {illust['id']}: {str(result)}")
+                        else:
+                            downloaded += result
+                    if downloaded:
+                        consecutive_errors = 0
 
-                            time.sleep(2)
-                    
                     page += 1
-                    time.sleep(4)  # Wait between pages
 
                 except Exception as e:
                     print(f"Error during search: {str(e)}")
@@ -259,14 +361,20 @@ class PixivCrawler:
 
                     # If we get too many errors, rotate cookie
                     if consecutive_errors >= 1:
-                        self.rotate_cookie()
+                        await self.rotate_cookie(cookie_index)
                         consecutive_errors = 0
 
-                    time.sleep(5)  # Wait before retrying
+                    await asyncio.sleep(5)  # Wait before retrying
                     continue
                 
-        print(f"Downloaded {downloaded_count} images to {self.output_dir}")
-        print(f"Metadata saved to {self.metadata_dir}")
+        print(f"Downloaded {self.downloaded_count} images to {self.output_dir}")
+        print(f"Metadata saved to {self.metadata_file}")
+
+
+async def run(crawler, args):
+    async with crawler:
+        await crawler.search_and_download(
+            args.tags, args.max_images, args.mode, args.rating)
 
 
 def main():
@@ -283,11 +391,15 @@ def main():
                         help='Search mode: s_tag_full (all tags must match) or s_tag (any tag can match)')
     parser.add_argument('--rating', choices=['all', 'safe', 'r18'], default='all',
                         help='Content rating: all, safe, or r18')
+    parser.add_argument('--exclude-tags', nargs='+',
+                        help='Skip works carrying any of these tags (space-separated)')
+    parser.add_argument('--skip-ai', action='store_true',
+                        help='Skip AI-generated works')
     args = parser.parse_args()
 
-    crawler = PixivCrawler(args.cookie_file, args.output_dir)
-    crawler.search_and_download(
-        args.tags, args.max_images, args.mode, args.rating)
+    crawler = PixivCrawler(args.cookie_file, args.output_dir,
+                           exclude_tags=args.exclude_tags, skip_ai=args.skip_ai)
+    asyncio.run(run(crawler, args))
 
 
 if __name__ == "__main__":
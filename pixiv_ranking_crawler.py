@@ -1,36 +1,55 @@
 import os
-import json
 import time
 import argparse
-import requests
+import httpx
 from tqdm import tqdm
-from pathlib import Path
+from utils import json_loads, json_dumps_line, PageCacheDropper
+
+
+METADATA_FLUSH_INTERVAL = 100
 
 
 class PixivRankingCrawler:
     def __init__(self, cookie_file, output_dir="ranking_images", mode="daily", date=None):
         self.cookies = self.load_cookie(cookie_file)
         self.output_dir = output_dir
-        self.metadata_dir = os.path.join(output_dir, "metadata")
         self.mode = mode
         self.date = date
         self.session = self.create_session()
         os.makedirs(self.output_dir, exist_ok=True)
-        os.makedirs(self.metadata_dir, exist_ok=True)
+        # Scan once so skip checks don't stat() every candidate file
+        self._existing = {entry.name for entry in os.scandir(self.output_dir) if entry.is_file()}
+        self.meta_fp = open(os.path.join(self.output_dir, "metadata.jsonl"), 'ab')
+        self.page_cache = PageCacheDropper()
+        self.metadata_count = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        # Runs on errors and Ctrl-C too, so buffered metadata is never lost
+        self.session.close()
+        self.meta_fp.close()
 
     def load_cookie(self, path):
         with open(path, 'r') as f:
             return f.readline().strip()
 
     def create_session(self):
-        session = requests.Session()
-        session.headers.update({
-            'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64)',
-            'Referer': 'https://www.pixiv.net/ranking.php?mode=daily',
-            'Accept-Language': 'ja,en-US;q=0.9,en;q=0.8'
-        })
-        session.cookies.set('PHPSESSID', self.cookies, domain='.pixiv.net')
-        return session
+        cookies = httpx.Cookies()
+        cookies.set('PHPSESSID', self.cookies, domain='.pixiv.net')
+        return httpx.Client(
+            http2=True,
+            headers={
+                'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64)',
+                'Referer': 'https://www.pixiv.net/ranking.php?mode=daily',
+                'Accept-Language': 'ja,en-US;q=0.9,en;q=0.8'
+            },
+            cookies=cookies,
+            timeout=30.0,
+            limits=httpx.Limits(max_connections=100, max_keepalive_connections=20),
+            follow_redirects=True
+        )
 
     def get_illust_ids(self, page=1):
         url = "https://www.pixiv.net/ranking.php"
@@ -47,7 +66,7 @@ class PixivRankingCrawler:
         print(f"[DEBUG] status_code: {resp.status_code}")
         resp.raise_for_status()
 
-        data = resp.json()
+        data = json_loads(resp.content)
         contents = data.get("contents", [])
         illust_ids = [str(item["illust_id"]) for item in contents if "illust_id" in item]
 
@@ -58,7 +77,7 @@ class PixivRankingCrawler:
         url = f"https://www.pixiv.net/ajax/illust/{illust_id}"
         resp = self.session.get(url)
         resp.raise_for_status()
-        data = resp.json()
+        data = json_loads(resp.content)
 
         if data.get("error"):
             return None, None
@@ -83,29 +102,34 @@ class PixivRankingCrawler:
         return image_url, metadata
 
     def download_image(self, url, illust_id, metadata):
-        try:
-            filename = f"{illust_id}.jpg"
-            filepath = os.path.join(self.output_dir, filename)
-
-            if os.path.exists(filepath):
-                return False
+        filename = f"{illust_id}.jpg"
+        filepath = os.path.join(self.output_dir, filename)
+        if filename in self._existing:
+            return False
 
+        try:
             headers = {'Referer': 'https://www.pixiv.net/'}
-            resp = self.session.get(url, headers=headers, stream=True)
-            resp.raise_for_status()
+            with self.session.stream('GET', url, headers=headers) as resp:
+                resp.raise_for_status()
 
-            with open(filepath, 'wb') as f:
-                for chunk in resp.iter_content(chunk_size=8192):
-                    f.write(chunk)
+                with open(filepath, 'wb') as f:
+                    for chunk in resp.iter_bytes(65536):
+                        f.write(chunk)
 
-            metadata_path = Path(self.metadata_dir) / f"{illust_id}.json"
-            with open(metadata_path, 'w', encoding='utf-8') as f:
-                json.dump(metadata, f, ensure_ascii=False, indent=2)
+            self.page_cache.add(filepath)
+            self._existing.add(filename)
+            self.meta_fp.write(json_dumps_line(metadata))
+            self.metadata_count += 1
+            if self.metadata_count % METADATA_FLUSH_INTERVAL == 0:
+                self.meta_fp.flush()
 
             return True
 
         except Exception as e:
             print(f"[ERROR] Download failed for {url}: {e}")
+            # Don't leave a truncated file behind, it would be skipped on later runs
+            if os.path.exists(filepath):
+                os.remove(filepath)
             return False
 
     def run(self, max_images=100):
@@ -154,5 +178,5 @@ if __name__ == "__main__":
     parser.add_argument("--max_images", type=int, default=100)
     args = parser.parse_args()
 
-    crawler = PixivRankingCrawler(args.cookie_file, args.output_dir, args.mode, args.date)
-    crawler.run(args.max_images)
+    with PixivRankingCrawler(args.cookie_file, args.output_dir, args.mode, args.date) as crawler:
+        crawler.run(args.max_images)
@@ -1,7 +1,15 @@
-import time
+import asyncio
 import argparse
-import requests
+import httpx
+import aiofiles
 from pathlib import Path
+from utils import json_loads, PageCacheDropper
+
+
+MAX_RETRIES = 5
+BACKOFF_BASE = 60  # Seconds to wait on the first retry when no Retry-After is sent
+QUOTA_POLL_INTERVAL = 10 * 60  # The hourly quota resets on its own, poll until it does
+RETRY_STATUSES = {429, 500, 502, 503, 504}
 
 
 class Crawler:
@@ -18,49 +26,101 @@ class Crawler:
             "Accept-Version": "v1",
             "Authorization": f"Client-ID {access_key}"
         }
+        self.page_cache = PageCacheDropper()
 
-    def download_image(self, url, filepath):
+    async def download_image(self, client, url, filepath):
         try:
-            img_data = requests.get(url).content
-            with open(filepath, 'wb') as f:
-                f.write(img_data)
+            async with client.stream("GET", url) as r:
+                r.raise_for_status()
+                async with aiofiles.open(filepath, 'wb') as f:
+                    async for chunk in r.aiter_bytes(65536):
+                        await f.write(chunk)
+            self.page_cache.add(filepath)
         except Exception as e:
             print(f"Download failed: {e}")
+            # Don't leave a truncated file behind, it would be skipped on later runs
+            if filepath.exists():
+                filepath.unlink()
+
+    async def search(self, client, params):
+        """Fetch a search page, backing off on rate limits, server and transport errors
+
+        Returns None if the page still fails after MAX_RETRIES attempts.
+        """
+        attempt = 0
+        while True:
+            try:
+                r = await client.get("https://api.unsplash.com/search/photos", headers=self.headers, params=params)
+            except httpx.TransportError as e:
+                r = None
+                reason = f"{type(e).__name__}: {e}"
+            else:
+                # Unsplash answers 403 once the hourly quota is used up; wait for the
+                # reset instead of giving up, or every following page would be lost too
+                if r.status_code == 403 and r.headers.get("X-Ratelimit-Remaining") == "0":
+                    print(f'[Status Code:403] Rate limit reached, retrying in {QUOTA_POLL_INTERVAL}s')
+                    await asyncio.sleep(QUOTA_POLL_INTERVAL)
+                    continue
+                if r.status_code not in RETRY_STATUSES:
+                    return r
+                reason = f"Status Code:{r.status_code}"
+
+            attempt += 1
+            if attempt == MAX_RETRIES:
+                print(f'[{reason}] Giving up after {MAX_RETRIES} attempts')
+                return None
+
+            retry_after = r.headers.get("Retry-After", "") if r is not None else ""
+            delay = int(retry_after) if retry_after.isdigit() else BACKOFF_BASE * 2 ** (attempt - 1)
+            print(f'[{reason}] Retrying in {delay}s ({attempt}/{MAX_RETRIES})')
+            await asyncio.sleep(delay)
+
+    async def crawl(self):
+        async with httpx.AsyncClient(http2=True, timeout=30.0, follow_redirects=True) as client:
+            for page in range(self.start_page, self.max_page + 1):
+                if not await self.crawl_page(client, page):
+                    break
 
-    def crawl(self):
-        for page in range(self.start_page, self.max_page + 1):
-            print(f"[Query: {self.query}] Page: {page} Fetching...")
+    async def crawl_page(self, client, page):
+        """Fetch one search page and download its images, return False when done"""
+        print(f"[Query: {self.query}] Page: {page} Fetching...")
 
-            params = {
-                "query": self.query,
-                "page": page,
-                "per_page": self.per_page
-            }
-            r = requests.get("https://api.unsplash.com/search/photos", headers=self.headers, params=params)
+        params = {
+            "query": self.query,
+            "page": page,
+            "per_page": self.per_page
+        }
+        r = await self.search(client, params)
 
-            if r.status_code == 200:
-                data = r.json()
-                results = data.get("results", [])
+        if r is None:
+            print(f'Skipping page {page}')
+        elif r.status_code == 200:
+            data = json_loads(r.content)
+            results = data.get("results", [])
 
-                print(f'Total: {data.get("total")} | Total Pages: {data.get("total_pages")}')
-                if not results:
-                    break
-                if data.get("total_pages", self.max_page) < page:
-                    break
+            print(f'Total: {data.get("total")} | Total Pages: {data.get("total_pages")}')
+            if not results:
+                return False
+            if data.get("total_pages", self.max_page) < page:
+                return False
 
-                for i, item in enumerate(data.get("results", [])):
-                    img_url = item["urls"]["regular"]
-                    img_id = item["id"]
-                    filepath = self.save_dir / f"{img_id}.jpg"
+            # Images come from the CDN, download the whole page at once
+            downloads = []
+            for item in results:
+                img_url = item["urls"]["regular"]
+                img_id = item["id"]
+                filepath = self.save_dir / f"{img_id}.jpg"
 
-                    if not filepath.exists():
-                        self.download_image(img_url, filepath)
+                if not filepath.exists():
+                    downloads.append(self.download_image(client, img_url, filepath))
+            await asyncio.gather(*downloads)
 
-                time.sleep(90)
+            await asyncio.sleep(90)
 
-            else:
-                print(f'[Status Code:{r.status_code}] Waiting for 1 hour')
-                time.sleep(60*60)
+        else:
+            print(f'[Status Code:{r.status_code}] Skipping page {page}')
+
+        return True
 
 
 def main():
@@ -79,7 +139,7 @@ def main():
         args.max_page,
         args.access_key
     )
-    crawler.crawl()
+    asyncio.run(crawler.crawl())
 
 
 if __name__ == '__main__':
@@ -0,0 +1,70 @@
+import os
+import time
+import dataclasses
+from collections import deque
+
+try:
+    import orjson
+except ImportError:  # fall back to the stdlib when orjson is unavailable
+    import json
+    orjson = None
+
+
+def json_loads(data):
+    """Parse JSON from bytes or str"""
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+def json_dumps_line(obj):
+    """Serialize obj to a compact UTF-8 JSON line terminated by a newline"""
+    if orjson is not None:
+        return orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS | orjson.OPT_APPEND_NEWLINE)
+    return (json.dumps(obj, ensure_ascii=False, separators=(",", ":"), default=_json_default) + "\n").encode("utf-8")
+
+
+# Linux writes dirty pages back after vm.dirty_expire_centisecs (30 s by default)
+WRITEBACK_DELAY = 35
+
+
+def drop_page_cache(path):
+    """Evict a downloaded file's clean pages from the page cache"""
+    if not hasattr(os, "posix_fadvise"):  # Not available on Windows/macOS
+        return
+    # Only a hint: failures must never turn a finished download into a failed one
+    try:
+        fd = os.open(path, os.O_RDONLY)
+        try:
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+        finally:
+            os.close(fd)
+    except OSError:
+        pass
+
+
+class PageCacheDropper:
+    """Drop finished downloads from the page cache once the kernel has written them back
+
+    DONTNEED leaves dirty pages alone, so dropping a file right after writing
+    it does nothing. Files are queued instead and evicted WRITEBACK_DELAY
+    seconds later, without forcing a sync of each file.
+    """
+
+    def __init__(self, delay=WRITEBACK_DELAY):
+        self.delay = delay
+        self._pending = deque()
+
+    def add(self, path):
+        now = time.monotonic()
+        self._pending.append((now, path))
+        # Files older than the delay are clean by now, fadvise on them is cheap
+        while self._pending and now - self._pending[0][0] >= self.delay:
+            drop_page_cache(self._pending.popleft()[1])
+
+
+def _json_default(obj):
+    # orjson serializes dataclasses natively, the stdlib needs them as dicts
+    if dataclasses.is_dataclass(obj):
+        return dataclasses.asdict(obj)
+    raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")